@@ -62,6 +62,23 @@ def set_caching(enabled=True):
     _state.caching_enabled = enabled
 
 
-__all__ = ["init", "set_exception_handler", "setup_exception_handler", "set_caching"]
+def clear_failed_generations():
+    """Forget generations that previously produced invalid code.
+
+    Failed generations are not retried within a process; call this to let
+    the next import try again.
+    """
+    from ._generator import clear_failed_generations
+
+    clear_failed_generations()
+
+
+__all__ = [
+    "init",
+    "set_exception_handler",
+    "setup_exception_handler",
+    "set_caching",
+    "clear_failed_generations",
+]
 
 init()
@@ -3,7 +3,8 @@
 import os
 import hashlib
 import json
-from ._state import caching_enabled
+import tempfile
+from . import _state
 
 
 def get_cache_dir():
@@ -27,7 +28,7 @@ def get_cache_path(fullname):
 
 def get_cached_data(fullname):
     """Get the cached data for a module if it exists."""
-    if not caching_enabled:
+    if not _state.caching_enabled:
         return None
 
     cache_path = get_cache_path(fullname)
@@ -41,7 +42,7 @@ def get_cached_data(fullname):
 
 def get_cached_code(fullname):
     """Get the cached code for a module if it exists."""
-    if not caching_enabled:
+    if not _state.caching_enabled:
         return None
 
     data = get_cached_data(fullname)
@@ -52,7 +53,7 @@ def get_cached_code(fullname):
 
 def get_cached_prompt(fullname):
     """Get the cached initial prompt for a module if it exists."""
-    if not caching_enabled:
+    if not _state.caching_enabled:
         return None
 
     data = get_cached_data(fullname)
@@ -63,7 +64,7 @@ def get_cached_prompt(fullname):
 
 def cache_module(fullname, code, prompt):
     """Cache the code and prompt for a module."""
-    if not caching_enabled:
+    if not _state.caching_enabled:
         return
 
     cache_path = get_cache_path(fullname)
@@ -74,7 +75,7 @@ def cache_module(fullname, code, prompt):
 
 def get_all_modules():
     """Get all cached modules."""
-    if not caching_enabled:
+    if not _state.caching_enabled:
         return {}
 
     cache_dir = get_cache_dir()
@@ -98,3 +99,39 @@ def get_all_modules():
         pass
 
     return modules
+
+
+def get_generation_path(key):
+    """Get the path where a cached LLM generation should be stored."""
+    gen_dir = os.path.join(get_cache_dir(), "gen")
+    os.makedirs(gen_dir, exist_ok=True)
+    return os.path.join(gen_dir, f"{key}.py")
+
+
+def get_cached_generation(key):
+    """Get the cached generated code for a request key if it exists."""
+    if not _state.caching_enabled:
+        return None
+
+    try:
+        with open(get_generation_path(key), "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def cache_generation(key, code):
+    """Cache the generated code for a request key."""
+    if not _state.caching_enabled:
+        return
+
+    gen_path = get_generation_path(key)
+    # Write to a temporary file first so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(gen_path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(code)
+        os.replace(tmp_path, gen_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
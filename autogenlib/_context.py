@@ -1,6 +1,7 @@
 """Context management for autogenlib modules."""
 
 import ast
+import functools
 
 # Store the context of each module
 module_contexts = {}
@@ -19,26 +20,43 @@ def set_module_context(fullname, code):
     }
 
 
-def extract_defined_names(code):
-    """Extract all defined names (functions, classes, variables) from the code."""
+@functools.lru_cache(maxsize=32)
+def parse_code(code):
+    """Parse code into an AST, or return None if it is not valid Python.
+
+    The tree is also compiled, so code that parses but cannot be executed
+    (e.g. 'return' outside a function) is rejected as well. Results are
+    shared, so the tree built while validating generated code is reused
+    when the module context is set. Callers must not modify it.
+    """
     try:
         tree = ast.parse(code)
-        names = set()
-
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef):
-                names.add(node.name)
-            elif isinstance(node, ast.ClassDef):
-                names.add(node.name)
-            elif isinstance(node, ast.Assign):
-                for target in node.targets:
-                    if isinstance(target, ast.Name):
-                        names.add(target.id)
-
-        return names
+        compile(tree, "<generated>", "exec", dont_inherit=True)
+        return tree
     except SyntaxError:
+        return None
+
+
+def extract_defined_names(code):
+    """Extract all defined names (functions, classes, variables) from the code."""
+    tree = parse_code(code)
+    if tree is None:
         return set()
 
+    names = set()
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef):
+            names.add(node.name)
+        elif isinstance(node, ast.ClassDef):
+            names.add(node.name)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    names.add(target.id)
+
+    return names
+
 
 def is_name_defined(fullname):
     """Check if a name is defined in its module."""
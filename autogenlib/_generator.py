@@ -1,25 +1,219 @@
 """Code generation for autogenlib using OpenAI API."""
 
 import openai
+import httpx
 import os
-import ast
+import functools
+import hashlib
+import importlib.util
+import json
+import io
 import re
-from ._cache import get_all_modules, get_cached_prompt
+import string
+import urllib.parse
+from ._cache import (
+    get_all_modules,
+    get_cached_prompt,
+    get_cached_generation,
+    cache_generation,
+)
+from ._context import parse_code
 from logging import getLogger
 
+try:
+    import tiktoken
+except ImportError:  # Optional, only used for more precise token counts
+    tiktoken = None
+
 logger = getLogger(__name__)
 
+# HTTP/2 support in httpx needs the optional h2 package
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20)
+
+# Markdown code fence at the very start or end of an LLM response
+FENCE_RE = re.compile(r"\A\s*```(?:python)?\n?|\n?```\s*\Z")
+
+# Prompts shorter than this are never cached by OpenAI or Anthropic
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+# Lines of surrounding code to include around each relevant caller line
+CALLER_CONTEXT_LINES = 3
+
+# Default token budget for caller code, see AUTOGENLIB_MAX_CALLER_TOKENS
+MAX_CALLER_TOKENS = 4000
+
+SYSTEM_MESSAGE = """
+You are an expert Python developer tasked with generating high-quality, production-ready Python modules.
+
+Follow these guidelines precisely:
+
+1. CODE QUALITY:
+   - Write clean, efficient, and well-documented code with docstrings
+   - Follow PEP 8 style guidelines strictly
+   - Include type hints where appropriate (Python 3.12+ compatible)
+   - Add comprehensive error handling for edge cases
+   - Create descriptive variable names that clearly convey their purpose
+
+2. UNDERSTANDING CONTEXT:
+   - Carefully analyze existing code to maintain consistency
+   - Match the naming conventions and patterns in related modules
+   - Ensure your implementation will work with the exact data structures shown in caller code
+   - Make reasonable assumptions when information is missing, but document those assumptions
+
+3. RESPONSE FORMAT:
+   - ONLY provide clean Python code with no explanations outside of code comments
+   - Do NOT include markdown formatting, explanations, or any text outside the code
+   - Do NOT include ```python or ``` markers around your code
+   - Your entire response should be valid Python code that can be executed directly
+
+4. IMPORTS:
+   - Use only Python standard library modules unless explicitly told otherwise
+   - If you need to import from within the library (autogenlib), do so as if those modules exist
+   - Format imports according to PEP 8 (stdlib, third-party, local)
+
+The code you generate will be directly executed by the Python interpreter, so it must be syntactically perfect.
+"""
+
+# Static prompt headers. These must not contain any per-call data: providers
+# only reuse cached prompt prefixes on exact matches.
+EXTEND_MODULE_HEADER = """
+TASK: Extend an existing Python module with a new function/class.
+
+IMPORTANT INSTRUCTIONS:
+1. Keep all existing functions and classes intact
+2. Follow the existing coding style for consistency
+3. Add comprehensive docstrings and comments where needed
+4. Include proper type hints and error handling
+5. Return ONLY the complete Python code for the entire module
+6. Do NOT include any explanations or markdown formatting in your response
+
+"""
+
+NEW_MODULE_HEADER = """
+TASK: Create a new Python module with a specific function/class.
+
+IMPORTANT INSTRUCTIONS:
+1. Start with an appropriate module docstring summarizing the purpose
+2. Include comprehensive docstrings for all functions/classes
+3. Add proper type hints and error handling
+4. Return ONLY the complete Python code for the module
+5. Do NOT include any explanations or markdown formatting in your response
+
+"""
+
+NEW_PACKAGE_HEADER = """
+TASK: Create a new Python package module.
+
+IMPORTANT INSTRUCTIONS:
+1. Create a well-structured module with appropriate functions and classes
+2. Start with a comprehensive module docstring
+3. Include proper docstrings, type hints, and error handling
+4. Return ONLY the complete Python code without any explanations
+5. Do NOT include file paths or any markdown formatting in your response
+
+"""
+
+
+# Per-call prompt tails, appended after the static header and codebase context.
+# Built once at import; each call only substitutes the placeholders.
+EXTEND_MODULE_TEMPLATE = string.Template("""
+MODULE NAME: '$module_name'
+
+LIBRARY PURPOSE:
+$current_description
+
+EXISTING MODULE CODE:
+```python
+$existing_code
+```
+
+CALLER CONTEXT:
+$caller_context
+
+REQUIREMENTS:
+Add a new $kind named '$function_name' that implements:
+$description
+""")
+
+NEW_MODULE_TEMPLATE = string.Template("""
+MODULE NAME: '$module_name'
+
+LIBRARY PURPOSE:
+$current_description
+
+CALLER CONTEXT:
+$caller_context
+
+REQUIREMENTS:
+Create a module that contains a $kind named '$function_name' that implements:
+$description
+""")
+
+NEW_PACKAGE_TEMPLATE = string.Template("""
+MODULE NAME: '$module_name'
+
+LIBRARY PURPOSE:
+$current_description
+
+CALLER CONTEXT:
+$caller_context
+
+REQUIREMENTS:
+Implement functionality for:
+$description
+""")
+
+
+def _specialize_kind(template):
+    """Pre-fill $kind, returning the (function, class) variants of a template."""
+    return tuple(
+        string.Template(template.safe_substitute(kind=kind))
+        for kind in ("function", "class")
+    )
+
+
+# Indexed by whether the requested name is capitalized (i.e. a class)
+EXTEND_MODULE_TEMPLATES = _specialize_kind(EXTEND_MODULE_TEMPLATE)
+NEW_MODULE_TEMPLATES = _specialize_kind(NEW_MODULE_TEMPLATE)
+
 
 def validate_code(code):
     """Validate the generated code against PEP standards."""
     try:
-        # Check if the code is syntactically valid
-        ast.parse(code)
+        # Check if the code is syntactically valid. compile() also rejects code
+        # that parses but cannot be executed, e.g. 'return' outside a function.
+        compile(code, "<generated>", "exec", dont_inherit=True)
         return True
     except SyntaxError:
         return False
 
 
+def _quick_reject(response):
+    """Cheaply detect an LLM response that cannot contain usable code."""
+    if not response:
+        return True
+    return response.lstrip().startswith(("I'm sorry", "I cannot"))
+
+
+# Request keys for which the LLM returned unusable code, oldest first. The
+# key covers the model and the full prompt, so a changed model, module code
+# or caller is retried. Only invalid output is recorded; API errors may be
+# transient and are retried.
+failed_generations = {}
+
+# Oldest failures are forgotten (and retried) beyond this many entries
+MAX_FAILED_GENERATIONS = 256
+
+
+def clear_failed_generations():
+    """Forget all failed generations so they are retried on the next import."""
+    failed_generations.clear()
+
+# Last rendered codebase context, keyed by a signature of the cached modules
+_ctx_cache = {"sig": None, "value": ""}
+
+
 def get_codebase_context():
     """Get the full codebase context for all cached modules."""
     modules = get_all_modules()
@@ -27,12 +221,25 @@ def get_codebase_context():
     if not modules:
         return ""
 
-    context = "Here is the existing codebase for reference:\n\n"
+    # Reuse the previous rendering if no module code has changed
+    sig = hash(
+        tuple(
+            sorted((name, hash(data.get("code", ""))) for name, data in modules.items())
+        )
+    )
+    if _ctx_cache["sig"] == sig:
+        return _ctx_cache["value"]
+
+    parts = ["Here is the existing codebase for reference:\n\n"]
 
-    for module_name, data in modules.items():
+    # Sort by module name so the context is byte-identical across calls
+    for module_name, data in sorted(modules.items()):
         if "code" in data:
-            context += f"# Module: {module_name}\n```python\n{data['code']}\n```\n\n"
+            parts.append(f"# Module: {module_name}\n```python\n{data['code']}\n```\n\n")
 
+    context = "".join(parts)
+    _ctx_cache["sig"] = sig
+    _ctx_cache["value"] = context
     return context
 
 
@@ -52,6 +259,12 @@ def extract_python_code(response):
     if validate_code(response):
         return response
 
+    # Most responses are a single fenced block, so try stripping just the
+    # fences at both ends before searching the whole text for code blocks
+    stripped = FENCE_RE.sub("", response)
+    if stripped != response and validate_code(stripped):
+        return stripped
+
     # Try to extract code from markdown code blocks
     code_block_pattern = r"```(?:python)?(.*?)```"
     matches = re.findall(code_block_pattern, response, re.DOTALL)
@@ -115,68 +328,157 @@ def extract_python_code(response):
     return extracted_code
 
 
-def generate_code(description, fullname, existing_code=None, caller_info=None):
-    """Generate code using the OpenAI API."""
+@functools.lru_cache(maxsize=8)
+def get_encoding(model):
+    """Get the tiktoken encoding for a model, or None if it is unavailable.
+
+    Encodings are thread-safe, so one instance per model is shared
+    process-wide; this also avoids retrying a failed load on every call.
+    """
+    if tiktoken is None:
+        return None
+
+    try:
+        try:
+            # Strip provider prefixes such as 'openai/gpt-4.1'
+            return tiktoken.encoding_for_model(model.rsplit("/", 1)[-1])
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.debug(f"Could not load tiktoken encoding for {model}: {e}")
+        return None
+
+
+def count_tokens(text, model):
+    """Count the tokens in text, estimating 4 characters per token without tiktoken."""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens, model):
+    """Truncate text to at most max_tokens tokens, cutting at a line boundary.
+
+    Falls back to an estimate of 4 characters per token without tiktoken.
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        if len(text) <= max_tokens * 4:
+            return text
+        text = text[: max_tokens * 4]
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        text = encoding.decode(tokens[:max_tokens])
+
+    cut_point = text.rfind("\n")
+    if cut_point != -1:
+        text = text[:cut_point]
+    return text + "\n# ... [truncated due to size] ..."
+
+
+def extract_snippets(lines, indices, context=CALLER_CONTEXT_LINES):
+    """Join the given lines with surrounding context, merging overlapping windows."""
+    snippets = []
+    start = end = None
+
+    for i in sorted(indices):
+        lo, hi = max(i - context, 0), min(i + context + 1, len(lines))
+        if end is not None and lo <= end:
+            end = max(end, hi)
+            continue
+        if end is not None:
+            snippets.append("\n".join(lines[start:end]))
+        start, end = lo, hi
+
+    if end is not None:
+        snippets.append("\n".join(lines[start:end]))
+    return "\n# ...\n".join(snippets)
+
+
+def is_openai_api(base_url):
+    """Check whether the configured base URL points at the OpenAI API."""
+    if not base_url:
+        return True
+    return urllib.parse.urlsplit(base_url).hostname == "api.openai.com"
+
+
+def build_request(description, fullname, existing_code=None, caller_info=None):
+    """Build the chat completion arguments for generating a module.
+
+    Returns None if the fullname does not refer to an autogenlib module.
+    """
     parts = fullname.split(".")
     if len(parts) < 2:
         return None
 
     module_name = parts[1]
     function_name = parts[2] if len(parts) > 2 else None
+    model = os.environ.get("OPENAI_MODEL", "gpt-4.1")
 
     # Get the cached prompt or use the provided description
     module_to_check = ".".join(fullname.split(".")[:2])  # e.g., 'autogenlib.totp'
     cached_prompt = get_cached_prompt(module_to_check)
     current_description = cached_prompt or description
 
-    # Get the full codebase context
-    codebase_context = get_codebase_context()
-
     # Add caller code context if available
     caller_context = ""
     if caller_info and caller_info.get("code"):
         code = caller_info.get("code", "")
         # Extract the most relevant parts of the code if possible
         # Try to focus on the sections that use the requested module/function
-        relevant_parts = []
+        relevant_lines = set()
         module_parts = fullname.split(".")
 
-        if len(module_parts) >= 2:
-            # Look for imports of this module
-            module_prefix = f"from {module_parts[0]}.{module_parts[1]}"
-            import_lines = [line for line in code.split("\n") if module_prefix in line]
-            if import_lines:
-                relevant_parts.extend(import_lines)
-
-            # Look for usages of the imported functions
-            if len(module_parts) >= 3:
-                func_name = module_parts[2]
-                func_usage_lines = [
-                    line
-                    for line in code.split("\n")
-                    if func_name in line and not line.startswith(("import ", "from "))
-                ]
-                if func_usage_lines:
-                    relevant_parts.extend(func_usage_lines)
-
-        # Include relevant parts if found, otherwise use the whole code
-        if relevant_parts:
+        # Look for imports of this module and usages of the imported
+        # function. Each pattern is first checked against the whole string,
+        # so files that never mention either skip the per-line scan entirely.
+        module_prefix = f"from {module_parts[0]}.{module_parts[1]}"
+        func_name = module_parts[2] if len(module_parts) >= 3 else None
+        has_import = module_prefix in code
+        has_usage = func_name is not None and func_name in code
+
+        if has_import or has_usage:
+            code_lines = code.split("\n")
+            for i, line in enumerate(code_lines):
+                if has_import and module_prefix in line:
+                    relevant_lines.add(i)
+                elif (
+                    has_usage
+                    and func_name in line
+                    and not line.startswith(("import ", "from "))
+                ):
+                    relevant_lines.add(i)
+
+        try:
+            max_caller_tokens = int(
+                os.environ.get("AUTOGENLIB_MAX_CALLER_TOKENS", MAX_CALLER_TOKENS)
+            )
+        except ValueError:
+            logger.warning(
+                f"Invalid AUTOGENLIB_MAX_CALLER_TOKENS value, using {MAX_CALLER_TOKENS}"
+            )
+            max_caller_tokens = MAX_CALLER_TOKENS
+
+        # Include only the relevant parts if found, otherwise use the whole code
+        if relevant_lines:
+            snippets = truncate_to_tokens(
+                extract_snippets(code_lines, relevant_lines), max_caller_tokens, model
+            )
             caller_context = f"""
             Here is the code that is importing and using this module/function:
             ```python
             # File: {caller_info.get("filename", "unknown")}
             # --- Relevant snippets ---
-            {"\n".join(relevant_parts)}
-            ```
-            
-            And here is the full context:
-            ```python
-            {code}
+            {snippets}
             ```
             
             Pay special attention to how the requested functionality will be used in the code snippets above.
             """
         else:
+            code = truncate_to_tokens(code, max_caller_tokens, model)
             caller_context = f"""
             Here is the code that is importing this module/function:
             ```python
@@ -189,168 +491,260 @@ def generate_code(description, fullname, existing_code=None, caller_info=None):
 
         logger.debug(f"Including caller context from {caller_info.get('filename')}")
 
-    # Create a prompt for the OpenAI API
-    system_message = """
-    You are an expert Python developer tasked with generating high-quality, production-ready Python modules.
-    
-    Follow these guidelines precisely:
-    
-    1. CODE QUALITY:
-       - Write clean, efficient, and well-documented code with docstrings
-       - Follow PEP 8 style guidelines strictly
-       - Include type hints where appropriate (Python 3.12+ compatible)
-       - Add comprehensive error handling for edge cases
-       - Create descriptive variable names that clearly convey their purpose
-    
-    2. UNDERSTANDING CONTEXT:
-       - Carefully analyze existing code to maintain consistency
-       - Match the naming conventions and patterns in related modules
-       - Ensure your implementation will work with the exact data structures shown in caller code
-       - Make reasonable assumptions when information is missing, but document those assumptions
-    
-    3. RESPONSE FORMAT:
-       - ONLY provide clean Python code with no explanations outside of code comments
-       - Do NOT include markdown formatting, explanations, or any text outside the code
-       - Do NOT include ```python or ``` markers around your code
-       - Your entire response should be valid Python code that can be executed directly
-    
-    4. IMPORTS:
-       - Use only Python standard library modules unless explicitly told otherwise
-       - If you need to import from within the library (autogenlib), do so as if those modules exist
-       - Format imports according to PEP 8 (stdlib, third-party, local)
-    
-    The code you generate will be directly executed by the Python interpreter, so it must be syntactically perfect.
-    """
-
+    # The static header goes first so that repeated calls share the longest
+    # possible prefix for provider-side prompt caching; everything that varies
+    # per call is appended after the codebase context.
+    is_class = bool(function_name) and function_name[0].isupper()
     if function_name and existing_code:
-        prompt = f"""
-        TASK: Extend an existing Python module named '{module_name}' with a new function/class.
-        
-        LIBRARY PURPOSE:
-        {current_description}
-        
-        EXISTING MODULE CODE:
-        ```python
-        {existing_code}
-        ```
-        
-        CODEBASE CONTEXT:
-        {codebase_context}
-        
-        CALLER CONTEXT:
-        {caller_context}
-        
-        REQUIREMENTS:
-        Add a new {"class" if function_name[0].isupper() else "function"} named '{function_name}' that implements:
-        {description}
-        
-        IMPORTANT INSTRUCTIONS:
-        1. Keep all existing functions and classes intact
-        2. Follow the existing coding style for consistency
-        3. Add comprehensive docstrings and comments where needed
-        4. Include proper type hints and error handling
-        5. Return ONLY the complete Python code for the entire module
-        6. Do NOT include any explanations or markdown formatting in your response
-        """
+        header = EXTEND_MODULE_HEADER
+        prompt = EXTEND_MODULE_TEMPLATES[is_class].substitute(
+            module_name=module_name,
+            current_description=current_description,
+            existing_code=existing_code,
+            caller_context=caller_context,
+            function_name=function_name,
+            description=description,
+        )
     elif function_name:
-        prompt = f"""
-        TASK: Create a new Python module named '{module_name}' with a specific function/class.
-        
-        LIBRARY PURPOSE:
-        {current_description}
-        
-        CODEBASE CONTEXT:
-        {codebase_context}
-        
-        CALLER CONTEXT:
-        {caller_context}
-        
-        REQUIREMENTS:
-        Create a module that contains a {"class" if function_name[0].isupper() else "function"} named '{function_name}' that implements:
-        {description}
-        
-        IMPORTANT INSTRUCTIONS:
-        1. Start with an appropriate module docstring summarizing the purpose
-        2. Include comprehensive docstrings for all functions/classes
-        3. Add proper type hints and error handling
-        4. Return ONLY the complete Python code for the module
-        5. Do NOT include any explanations or markdown formatting in your response
-        """
+        header = NEW_MODULE_HEADER
+        prompt = NEW_MODULE_TEMPLATES[is_class].substitute(
+            module_name=module_name,
+            current_description=current_description,
+            caller_context=caller_context,
+            function_name=function_name,
+            description=description,
+        )
     else:
-        prompt = f"""
-        TASK: Create a new Python package module named '{module_name}'.
-        
-        LIBRARY PURPOSE:
-        {current_description}
-        
-        CODEBASE CONTEXT:
-        {codebase_context}
-        
-        CALLER CONTEXT:
-        {caller_context}
-        
-        REQUIREMENTS:
-        Implement functionality for:
-        {description}
-        
-        IMPORTANT INSTRUCTIONS:
-        1. Create a well-structured module with appropriate functions and classes
-        2. Start with a comprehensive module docstring
-        3. Include proper docstrings, type hints, and error handling
-        4. Return ONLY the complete Python code without any explanations
-        5. Do NOT include file paths or any markdown formatting in your response
-        """
-
-    try:
-        # Set API key from environment variable
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("Please set the OPENAI_API_KEY environment variable.")
-
-        base_url = os.environ.get("OPENAI_API_BASE_URL")
-        model = os.environ.get("OPENAI_MODEL", "gpt-4.1")
-
-        # Initialize the OpenAI client
-        client = openai.OpenAI(api_key=api_key, base_url=base_url)
-
-        logger.debug("Prompt: %s", prompt)
-
-        # Call the OpenAI API
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.1,
+        header = NEW_PACKAGE_HEADER
+        prompt = NEW_PACKAGE_TEMPLATE.substitute(
+            module_name=module_name,
+            current_description=current_description,
+            caller_context=caller_context,
+            description=description,
         )
 
-        # Get the generated code
-        raw_response = response.choices[0].message.content.strip()
+    # A brand-new package prompt without the codebase context is well below
+    # the minimum size for provider-side prompt caching, so adding the context
+    # would only grow the input cost without ever producing a cache hit.
+    if (
+        function_name is None
+        and existing_code is None
+        and count_tokens(header + current_description, model) < PROMPT_CACHE_MIN_TOKENS
+    ):
+        codebase_context = ""
+    else:
+        # Get the full codebase context
+        codebase_context = get_codebase_context()
+
+    cache_provider = os.environ.get("AUTOGENLIB_CACHE_PROVIDER", "openai")
+
+    logger.debug("Prompt: %s%s%s", header, codebase_context, prompt)
+
+    if cache_provider == "anthropic":
+        # Claude only caches explicitly marked prefixes, so mark the end of
+        # the static part of the prompt as a cache breakpoint.
+        user_content = [
+            {
+                "type": "text",
+                "text": header + codebase_context,
+                "cache_control": {"type": "ephemeral"},
+            },
+            {"type": "text", "text": prompt},
+        ]
+        extra_body = None
+    else:
+        user_content = header + codebase_context + prompt
+        extra_body = None
+        # Pin requests for the same module to the same cache shard. Only the
+        # OpenAI API itself knows this field; compatible servers may reject it.
+        if is_openai_api(os.environ.get("OPENAI_API_BASE_URL")):
+            extra_body = {"prompt_cache_key": module_to_check}
+
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": SYSTEM_MESSAGE},
+            {"role": "user", "content": user_content},
+        ],
+        "temperature": 0.1,
+        "extra_body": extra_body,
+    }
+
+
+def get_api_settings():
+    """Get the API key and base URL from the environment."""
+    # Set API key from environment variable
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("Please set the OPENAI_API_KEY environment variable.")
+
+    base_url = os.environ.get("OPENAI_API_BASE_URL")
+    return api_key, base_url
+
+
+def finalize_code(raw_response):
+    """Extract and validate the module code from a raw LLM response."""
+    raw_response = raw_response.strip()
+
+    logger.debug("Raw response: %s", raw_response)
+
+    # Empty responses and refusals need neither extraction nor parsing
+    if _quick_reject(raw_response):
+        logger.error("LLM response does not contain any code")
+        return None
+
+    # Extract and clean the Python code from the response
+    code = extract_python_code(raw_response)
+
+    logger.debug("Extracted code: %s", code)
 
-        logger.debug("Raw response: %s", raw_response)
+    # Validate the code. Parse rather than just compile: the tree is cached
+    # and reused when the module context is set for the new code
+    if parse_code(code) is not None:
+        return code
+    else:
+        logger.error("Generated code is not valid. Attempting to fix...")
 
-        # Extract and clean the Python code from the response
-        code = extract_python_code(raw_response)
+        # Try to clean up common issues
+        # Remove any additional text before or after code blocks
+        clean_code = re.sub(r'^.*?(?=(?:"""|\'\'\'))', "", code, flags=re.DOTALL)
 
-        logger.debug("Extracted code: %s", code)
+        if parse_code(clean_code) is not None:
+            logger.info("Fixed code validation issues")
+            return clean_code
+
+        logger.error("Generated code is not valid and could not be fixed")
+        return None
 
-        # Validate the code
-        if validate_code(code):
-            return code
-        else:
-            logger.error("Generated code is not valid. Attempting to fix...")
 
-            # Try to clean up common issues
-            # Remove any additional text before or after code blocks
-            clean_code = re.sub(r'^.*?(?=(?:"""|\'\'\'))', "", code, flags=re.DOTALL)
+@functools.lru_cache(maxsize=1)
+def get_client(api_key, base_url):
+    """Get an OpenAI client, shared between calls with the same settings.
+
+    Keeping one client alive lets consecutive generations reuse the
+    keep-alive (and, with h2 installed, HTTP/2) connection instead of
+    paying for a new TCP and TLS handshake each time.
+    """
+    http_client = openai.DefaultHttpxClient(http2=HTTP2_AVAILABLE, limits=HTTP_LIMITS)
+    return openai.OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+
+def get_request_key(request):
+    """Get a stable cache key for a chat completion request."""
+    payload = request["model"] + json.dumps(request["messages"], sort_keys=True)
+    # No cryptographic requirement here, blake2b is just fast
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def prepare_generation(description, fullname, existing_code=None, caller_info=None):
+    """Run the steps shared by all generation paths before calling the API.
+
+    Returns:
+        tuple: (request, key, code). request is None when no API call is
+        needed; code is then the cached generation, if there is one.
+    """
+    request = build_request(description, fullname, existing_code, caller_info)
+    if request is None:
+        return None, None, None
+
+    key = get_request_key(request)
+    if key in failed_generations:
+        logger.debug(f"Skipping {fullname}: generation previously failed")
+        return None, key, None
+
+    # Identical requests are answered from the local cache
+    code = get_cached_generation(key)
+    if code is not None and parse_code(code) is not None:
+        logger.debug(f"Using cached generation {key} for {fullname}")
+        return None, key, code
+
+    return request, key, None
+
+
+def record_generation(key, code):
+    """Store the result of an API generation in the response or failure cache."""
+    if code is not None:
+        cache_generation(key, code)
+    else:
+        failed_generations[key] = None
+        if len(failed_generations) > MAX_FAILED_GENERATIONS:
+            # Dicts keep insertion order, so the first key is the oldest
+            del failed_generations[next(iter(failed_generations))]
+    return code
+
+
+def generate_code(description, fullname, existing_code=None, caller_info=None):
+    """Generate code using the OpenAI API."""
+    request, key, code = prepare_generation(
+        description, fullname, existing_code, caller_info
+    )
+    if request is None:
+        return code
+
+    try:
+        # Reuse the shared OpenAI client and its open connections
+        client = get_client(*get_api_settings())
+
+        # Call the OpenAI API; the stream is closed even if reading it fails
+        buf = io.StringIO()
+        with client.chat.completions.create(**request, stream=True) as response:
+            # Accumulate the streamed completion as it arrives
+            for chunk in response:
+                if chunk.choices:
+                    buf.write(chunk.choices[0].delta.content or "")
+
+        code = finalize_code(buf.getvalue())
+    except Exception as e:
+        logger.error(f"Error generating code: {e}")
+        return None
+
+    return record_generation(key, code)
 
-            if validate_code(clean_code):
-                logger.info("Fixed code validation issues")
-                return clean_code
 
-            logger.error("Generated code is not valid and could not be fixed")
+async def generate_code_async(
+    description, fullname, existing_code=None, caller_info=None, client=None
+):
+    """Generate code using the OpenAI API without blocking the event loop.
+
+    The import hook itself is synchronous and uses generate_code; this is
+    for callers that want to generate several modules concurrently, e.g.
+    with asyncio.gather over one shared client.
+
+    Args:
+        client: An openai.AsyncOpenAI client to reuse. A new one is created
+            from the environment (and closed afterwards) if not provided.
+    """
+    if client is None:
+        try:
+            api_key, base_url = get_api_settings()
+        except ValueError as e:
+            logger.error(f"Error generating code: {e}")
             return None
+
+        async with openai.AsyncOpenAI(api_key=api_key, base_url=base_url) as client:
+            return await generate_code_async(
+                description, fullname, existing_code, caller_info, client=client
+            )
+
+    request, key, code = prepare_generation(
+        description, fullname, existing_code, caller_info
+    )
+    if request is None:
+        return code
+
+    try:
+        # Call the OpenAI API; the stream is closed even if reading it fails
+        buf = io.StringIO()
+        response = await client.chat.completions.create(**request, stream=True)
+        async with response:
+            # Accumulate the streamed completion as it arrives
+            async for chunk in response:
+                if chunk.choices:
+                    buf.write(chunk.choices[0].delta.content or "")
+
+        code = finalize_code(buf.getvalue())
     except Exception as e:
         logger.error(f"Error generating code: {e}")
         return None
+
+    return record_generation(key, code)